@@ -30,10 +30,20 @@ import numpy as np
 import random
 # from sklearn.mixture import GaussianMixture  #  This works quite well, slightly better Sn
 from sklearn.cluster import AgglomerativeClustering
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from joblib import Memory, Parallel, delayed, effective_n_jobs
+from tempfile import mkdtemp
+from shutil import rmtree
 import sys
 from manta.flow import partial_diffusion, diffusion, harary_components
-from itertools import combinations, chain
-from copy import deepcopy
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional; without it, sparsity scores are computed with numpy
+    njit = None
+    prange = range
+from itertools import chain
 import os
 import logging.handlers
 
@@ -85,11 +95,9 @@ def cluster_graph(graph, limit, max_clusters, min_clusters, min_cluster_size,
     :param verbose: Verbosity level of function
     :return: NetworkX graph, score matrix and diffusion matrix.
     """
-        
-    adj_index = dict()
-    for i in range(len(graph.nodes)):
-        adj_index[list(graph.nodes)[i]] = i
-    rev_index = {v: k for k, v in adj_index.items()}
+    nodes = list(graph.nodes)
+    adj_index = {node: i for i, node in enumerate(nodes)}
+    rev_index = {i: node for i, node in enumerate(nodes)}
     # next part is to define scoring matrix
     balanced = [False]
     scoremat, memory, diffs = diffusion(graph=graph, limit=limit, iterations=iterations, verbose=verbose)
@@ -117,20 +125,21 @@ def cluster_graph(graph, limit, max_clusters, min_clusters, min_cluster_size,
         weak_nodes = cluster_weak(graph, diffs=diffs, cluster=flatcluster,
                                   edgescale=edgescale,
                                   adj_index=adj_index, rev_index=rev_index, verbose=verbose)
+        weak_nodes = set(weak_nodes)
         weak_dict = dict()
-        for node in graph.nodes:
+        for node in nodes:
             if adj_index[node] in weak_nodes:
                 weak_dict[node] = 'weak'
             else:
                 weak_dict[node] = 'strong'
-            nx.set_node_attributes(graph, values=weak_dict, name='assignment')
+        nx.set_node_attributes(graph, values=weak_dict, name='assignment')
     nx.set_node_attributes(graph, values=bestcluster, name='cluster')
     return graph, scoremat
 
 
-def sparsity_score(graph, clusters, rev_index):
+def sparsity_score(clusters, edge_u, edge_v, edge_w):
     """
-    Given a graph, and a list of cluster identities,
+    Given a list of cluster identities and the edges of a graph,
     this function calculates how many edges need to be cut
     to assign these cluster identities.
     Cuts through positively-weighted edges are penalized,
@@ -144,9 +153,10 @@ def sparsity_score(graph, clusters, rev_index):
 
     Parameters
     ----------
-    :param graph: NetworkX weighted, undirected graph
-    :param clusters: List of cluster identities
-    :param rev_index: Index matching node ID to matrix index
+    :param clusters: Vector of cluster identities, in matrix index order
+    :param edge_u: Matrix indices of edge sources, generated by _edge_arrays
+    :param edge_v: Matrix indices of edge targets, generated by _edge_arrays
+    :param edge_w: Edge weights, generated by _edge_arrays
     :return: Sparsity score
     """
     # set up scale for positive + negative edges
@@ -155,35 +165,61 @@ def sparsity_score(graph, clusters, rev_index):
     # all negative edges inside clusters and positive outside clusters
     # 1 is the best,
     # with clusters containing only positive edges
-    cut_score = 1/len(graph.edges)
-    sparsity = 0
-    edges = list()
-    for cluster_id in set(clusters):
-        # get the set of edges that is NOT in either cluster
-        node_ids = list(np.where(clusters == cluster_id)[0])
-        node_ids = [rev_index.get(item, item) for item in node_ids]
-        cluster = graph.subgraph(node_ids)
-        edges.extend(list(cluster.edges))
-        # penalize for having negative edges inside cluster
-        weights = nx.get_edge_attributes(cluster, 'weight')
-        for x in weights:
-            if weights[x] < 0:
-                sparsity -= cut_score
-            else:
-                sparsity += cut_score
-    all_edges = list(graph.edges)
-    cuts = list()
-    for edge in all_edges:
-        if edge not in edges and (edge[1], edge[0]) not in edges:
-            # problem with cluster edges having swapped orders
-            cuts.append(edge)
-    for edge in cuts:
-        cut = graph[edge[0]][edge[1]]['weight']
-        if cut > 0:
-            sparsity -= cut_score
+    clusters = np.asarray(clusters)
+    if njit is not None:
+        return _sparsity_kernel(clusters, edge_u, edge_v, edge_w)
+    same = clusters[edge_u] == clusters[edge_v]
+    # penalize for having negative edges inside cluster
+    # and for cutting through positive edges
+    signs = np.where(same, np.where(edge_w < 0, -1, 1), np.where(edge_w > 0, -1, 1))
+    return np.sum(signs) / len(edge_w)
+
+
+def _sparsity_kernel(clusters, edge_u, edge_v, edge_w):
+    """
+    Loop version of the sparsity score, which is compiled with numba if it is available.
+    When numba is available, the edges are split over threads;
+    because every edge adds -1 or 1, the result does not depend on the summation order.
+
+    Parameters
+    ----------
+    :param clusters: Vector of cluster identities, in matrix index order
+    :param edge_u: Matrix indices of edge sources
+    :param edge_v: Matrix indices of edge targets
+    :param edge_w: Edge weights
+    :return: Sparsity score
+    """
+    sparsity = 0.0
+    for i in prange(len(edge_w)):
+        if clusters[edge_u[i]] == clusters[edge_v[i]]:
+            # penalize for having negative edges inside cluster
+            sparsity += -1.0 if edge_w[i] < 0 else 1.0
         else:
-            sparsity += cut_score
-    return sparsity
+            # penalize for cutting through positive edges
+            sparsity += -1.0 if edge_w[i] > 0 else 1.0
+    return sparsity / len(edge_w)
+
+
+if njit is not None:
+    _sparsity_kernel = njit(parallel=True, cache=True)(_sparsity_kernel)
+
+
+def _edge_arrays(graph, adj_index):
+    """
+    Given a graph, this helper function returns the edges
+    as three parallel arrays of source indices, target indices and weights.
+    This allows sparsity scores to be computed without traversing the graph.
+
+    Parameters
+    ----------
+    :param graph: NetworkX weighted, undirected graph
+    :param adj_index: Index matching node ID to matrix index
+    :return: Tuple of source index, target index and weight arrays
+    """
+    edge_u = np.fromiter((adj_index[u] for u, v in graph.edges), dtype=np.int64, count=len(graph.edges))
+    edge_v = np.fromiter((adj_index[v] for u, v in graph.edges), dtype=np.int64, count=len(graph.edges))
+    edge_w = np.fromiter((w for u, v, w in graph.edges(data='weight')), dtype=np.float64, count=len(graph.edges))
+    return edge_u, edge_v, edge_w
 
 
 def cluster_hard(graph, adj_index, rev_index, scoremat,
@@ -206,101 +242,88 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
     :param verbose: Verbosity level of function
     :return: Dictionary of nodes with cluster assignments
     """
+    edge_arrays = _edge_arrays(graph, adj_index)
     # get the mean of 100 assignments
     randomscores = list()
     for i in range(5):
         rng = np.random.default_rng(seed+i)
         randomclust = rng.integers(2, size=len(scoremat))
-        randomscores.append(sparsity_score(graph, randomclust, rev_index))
+        randomscores.append(sparsity_score(randomclust, *edge_arrays))
     scores = dict()
     scores['random'] = np.median(randomscores)
     if verbose:
         logger.info('Sparsity level for 2 clusters, randomly assigned labels: ' + str(scores['random']))
     bestclusters = dict()
-    clusnum = min_clusters
-    scoremat_index = rev_index.copy()
+    bestindices = dict()
     outliers = dict()
-    outliers[clusnum] = list()
-    clustermat = scoremat.copy()
     # minimum cluster size is 10% of nodes
     minclus = len(graph) * min_cluster_size
-    while clusnum < max_clusters + 1:
-        clusters = AgglomerativeClustering(n_clusters=clusnum).fit_predict(clustermat)
-        counts = np.bincount(clusters)
-        # then add to cluster based on shortest paths
-        if len(np.where(counts > (minclus / clusnum))[0]) < 2:
-            logger.warning('All nodes are binned into a single cluster for k = ' + str(clusnum))
-            scores[clusnum] = -1
-            break
-        elif len(np.where(counts < (minclus / clusnum))[0]) > 0:
-            # if there are at least 5 cluster with fewer than 3 nodes,
-            # remove nodes that separate into tiny cluster
-            # get cluster ID and location for this cluster
-            locs = np.where(counts < (minclus / clusnum))[0]
-            # we only remove one cluster pos at a time
-            # repeated clustering may assign node differently
-            loc = locs[0]
-            clusid = list(set(clusters))[loc]
-            clusloc = np.where(clusters == clusid)[0][0]
-            # we need to update the rev_index so that adjacency indices point to taxon IDs
-            # outlier nodes are added to a list, to be dealt with later
-            outliers[clusnum].append(scoremat_index[clusloc])
-            clustermat, scoremat_index = _remove_node(clusloc, clustermat, scoremat_index)
-            # now the smaller clusters are deleted, we can cluster on the updated scoring matrix
-            if clustermat.shape[0] <= max_clusters:
-                # indicates that there is no good clustering possible for this cluster number
-                clusnum += 1
-                outliers[clusnum] = list()
-                # reset scoring matrix in case different cluster assignment does assign outliers
-                clustermat = scoremat.copy()
-                scoremat_index = rev_index.copy()
-        else:
-            scores[clusnum] = sparsity_score(graph, clusters, rev_index)
-            bestclusters[clusnum] = clusters
+    # the hierarchical tree only depends on the clustering matrix,
+    # so it is cached and cut again for every evaluated cluster number
+    cachedir = mkdtemp()
+    try:
+        memory = Memory(location=cachedir, verbose=0)
+        # build the tree for the full scoring matrix before the cluster numbers are evaluated in parallel
+        AgglomerativeClustering(n_clusters=min_clusters, memory=memory).fit(scoremat)
+        # the sweep keeps track of matrix indices, which the edge arrays also use
+        mat_index = {i: i for i in range(len(scoremat))}
+        # the sweep is consumed lazily, so no further cluster numbers are clustered after the break
+        sweep = _cluster_sweep(range(min_clusters, max_clusters + 1), scoremat, mat_index,
+                               minclus, max_clusters, memory)
+        for clusnum, (clusters, scoremat_index, clus_outliers) in sweep:
+            outliers[clusnum] = clus_outliers
+            if clusters is False:
+                logger.warning('All nodes are binned into a single cluster for k = ' + str(clusnum))
+                scores[clusnum] = -1
+                break
+            elif clusters is not None:
+                # outliers removed from the scoring matrix are not part of a cluster,
+                # so they get a unique ID and all their edges count as cuts
+                assignment = -np.arange(1, len(scoremat) + 1)
+                assignment[[scoremat_index[i] for i in range(len(clusters))]] = clusters
+                scores[clusnum] = sparsity_score(assignment, *edge_arrays)
+                bestclusters[clusnum] = clusters
+                bestindices[clusnum] = scoremat_index
+                if verbose:
+                    logger.info('Sparsity level of k=' + str(clusnum) + ' clusters: '
+                                + str(scores[clusnum]) + '.')
+        topscore = max(scores, key=scores.get)
+        if topscore != 'random':
             if verbose:
-                logger.info('Sparsity level of k=' + str(clusnum) + ' clusters: '
-                            + str(scores[clusnum]) + '.')
-            clusnum += 1
-            outliers[clusnum] = list()
-            # reset scoring matrix in case different cluster assignment does assign outliers
-            clustermat = scoremat.copy()
-            scoremat_index = rev_index.copy()
-    topscore = max(scores, key=scores.get)
-    if topscore != 'random':
-        if verbose:
-            logger.info('Highest score for k=' + str(topscore) + ' clusters: ' + str(scores[topscore]))
-    else:
-        logger.warning('Warning: random clustering performed best.'
-                       ' \n Setting cluster amount to minimum value.')
-        topscore = min_clusters
-        # it is possible that all evaluated cluster assignments did not work out
-        # in that case, the assignment below is without the binning strategy
-        if min_clusters not in bestclusters:
-            bestclusters[min_clusters] = AgglomerativeClustering(n_clusters=min_clusters).fit_predict(clustermat)
-    # given a topscore, clustering is carried out on scoremat without outliers
-    outlier_locs = [adj_index[x] for x in outliers[topscore]]
-    scoremat_index = rev_index.copy()
-    clustermat = scoremat.copy()
-    clustermat, scoremat_index = _remove_node(outlier_locs, clustermat, scoremat_index)
+                logger.info('Highest score for k=' + str(topscore) + ' clusters: ' + str(scores[topscore]))
+        else:
+            logger.warning('Warning: random clustering performed best.'
+                           ' \n Setting cluster amount to minimum value.')
+            topscore = min_clusters
+            # it is possible that all evaluated cluster assignments did not work out
+            # in that case, the assignment below is without the binning strategy
+            if min_clusters not in bestclusters:
+                bestclusters[min_clusters] = AgglomerativeClustering(n_clusters=min_clusters,
+                                                                     memory=memory).fit_predict(scoremat)
+                bestindices[min_clusters] = mat_index.copy()
+                outliers[min_clusters] = list()
+    finally:
+        # the cached trees are removed, also if the sweep fails
+        rmtree(cachedir, ignore_errors=True)
+    # given a topscore, the clustering on scoremat without outliers is reused
     bestcluster = bestclusters[topscore]
     # we need to assign outlier nodes to clusters after clustering on main network
-    corrdict = _path_weights(outliers[topscore], graph, verbose)
-    scoremat_index = {v: k for k, v in scoremat_index.items()}
+    corrdict = _path_weights([rev_index[x] for x in outliers[topscore]], graph, edge_arrays, adj_index, verbose)
+    scoremat_index = {v: k for k, v in bestindices[topscore].items()}
     # generate dictionary of cluster assignments
     # use this to reconstruct bestcluster vector
     cluster_index = adj_index.copy()
     for key in cluster_index:
         try:
-            cluster_index[key] = float(bestcluster[scoremat_index[key]])
+            cluster_index[key] = float(bestcluster[scoremat_index[adj_index[key]]])
         except KeyError:
             # key error happens for outlier that has not been assigned cluster ID yet
             pass
     # replace node values in corrdict with cluster ids
+    cluster_ids = list(set(bestcluster))
     for node in corrdict:
         # initialize list to store path values per cluster
-        clusdict = dict.fromkeys(set(bestcluster))
-        for key in clusdict:
-            clusdict[key] = list()
+        clusdict = {key: list() for key in cluster_ids}
         # lookup cluster ID of node
         for value in corrdict[node]:
             try:
@@ -308,11 +331,91 @@ def cluster_hard(graph, adj_index, rev_index, scoremat,
                 clusdict[clusid].append(corrdict[node][value])
             except KeyError:
                 pass
-        closest_cluster = list(set(bestcluster))[np.argmax([np.mean(clusdict[x]) for x in clusdict])]
+        closest_cluster = cluster_ids[np.argmax([np.mean(clusdict[x]) for x in cluster_ids])]
         cluster_index[node] = float(closest_cluster)
     return cluster_index
 
 
+def _cluster_sweep(cluster_numbers, scoremat, mat_index, minclus, max_clusters, memory):
+    """
+    Evaluates cluster numbers in parallel with _cluster_number.
+    The cluster numbers are submitted in ordered batches of one cluster number per worker,
+    and results are yielded in order, so a caller that stops iterating
+    does not cluster the remaining cluster numbers.
+
+    Parameters
+    ----------
+    :param cluster_numbers: Cluster numbers to evaluate, in order
+    :param scoremat: Converged diffusion matrix
+    :param mat_index: Index matching clustering matrix positions to matrix indices
+    :param minclus: Minimum cluster size as number of nodes
+    :param max_clusters: Maximum cluster number
+    :param memory: Joblib memory used to cache the hierarchical tree
+    :return: Generator of tuples with cluster number and _cluster_number result
+    """
+    cluster_numbers = list(cluster_numbers)
+    batch_size = effective_n_jobs(-1)
+    with Parallel(n_jobs=batch_size, prefer='threads') as parallel:
+        for start in range(0, len(cluster_numbers), batch_size):
+            batch = cluster_numbers[start:start + batch_size]
+            results = parallel(delayed(_cluster_number)(clusnum, scoremat, mat_index, minclus, max_clusters, memory)
+                               for clusnum in batch)
+            yield from zip(batch, results)
+
+
+def _cluster_number(clusnum, scoremat, mat_index, minclus, max_clusters, memory):
+    """
+    Carries out agglomerative clustering for a single cluster number.
+    Nodes that separate into tiny clusters are removed as outliers,
+    and clustering is repeated until all clusters are large enough.
+
+    Parameters
+    ----------
+    :param clusnum: Cluster number
+    :param scoremat: Converged diffusion matrix
+    :param mat_index: Index matching clustering matrix positions to matrix indices
+    :param minclus: Minimum cluster size as number of nodes
+    :param max_clusters: Maximum cluster number
+    :param memory: Joblib memory used to cache the hierarchical tree
+    :return: Tuple of cluster assignment, matrix index and matrix indices of outliers.
+    The cluster assignment is None if no good clustering is possible for this cluster number,
+    and False if all nodes are binned into a single cluster.
+    """
+    scoremat_index = mat_index.copy()
+    outliers = list()
+    # _remove_node returns a new matrix, so the scoring matrix does not need to be copied
+    clustermat = scoremat
+    while True:
+        if clusnum > clustermat.shape[0]:
+            # the tree cannot be cut into more clusters than there are nodes left
+            return None, scoremat_index, outliers
+        clusters = AgglomerativeClustering(n_clusters=clusnum, memory=memory).fit_predict(clustermat)
+        counts = np.bincount(clusters)
+        locs = np.flatnonzero(counts < (minclus / clusnum))
+        # then add to cluster based on shortest paths
+        if np.count_nonzero(counts > (minclus / clusnum)) < 2:
+            return False, scoremat_index, outliers
+        elif len(locs) > 0:
+            # if there are at least 5 cluster with fewer than 3 nodes,
+            # remove nodes that separate into tiny cluster
+            # get cluster ID and location for this cluster
+            # we only remove one cluster pos at a time
+            # repeated clustering may assign node differently
+            loc = locs[0]
+            clusid = list(set(clusters))[loc]
+            clusloc = np.where(clusters == clusid)[0][0]
+            # we need to update the matrix index so that positions point to the original matrix indices
+            # outlier nodes are added to a list, to be dealt with later
+            outliers.append(scoremat_index[clusloc])
+            clustermat, scoremat_index = _remove_node(clusloc, clustermat, scoremat_index)
+            # now the smaller clusters are deleted, we can cluster on the updated scoring matrix
+            if clustermat.shape[0] <= max_clusters:
+                # indicates that there is no good clustering possible for this cluster number
+                return None, scoremat_index, outliers
+        else:
+            return clusters, scoremat_index, outliers
+
+
 def cluster_weak(graph, diffs, cluster, edgescale, adj_index, rev_index, verbose):
     """
     Although clusters can be assigned with cluster_hard, cluster_weak tests
@@ -349,10 +452,14 @@ def cluster_weak(graph, diffs, cluster, edgescale, adj_index, rev_index, verbose
     # only upper triangle of matrix is indexed this way
     core, anti = _core_oscillators(difmats=diffs, assignment=cluster,
                                    adj_index=adj_index, rev_index=rev_index, verbose=verbose)
+    if len(core) == 0:
+        # without core oscillators, there are no paths to check
+        return list()
     # for each node with contrasting edge products,
     # we can check whether the sparsity score is improved by
     # removing the node or adding it to another cluster.
-    remove_cluster = _oscillator_paths(graph=graph, core_oscillators=core, assignment=cluster,
+    remove_cluster = _oscillator_paths(graph=graph, edge_arrays=_edge_arrays(graph, adj_index),
+                                       core_oscillators=core, assignment=cluster,
                                        adj_index=adj_index, edgescale=edgescale, verbose=verbose)
 
     # we only remove nodes with conflicting shortest paths if
@@ -397,18 +504,13 @@ def _core_oscillators(difmats, assignment, adj_index, rev_index, verbose):
     :param verbose: Verbosity level of function
     :return: Tuple with list of oscillators and dictionary of anti-correlated oscillators
     """
-    oscillators = list()
-    oscillators_series = list()
-    for index in range(len(assignment)):
-        # node amplitude is NOT correlated to position in network
-        seq = difmats[:, index, index]
-        ampli = np.max(seq) - np.min(seq)
-        if ampli > 0.5:
-            # if the amplitude is this large,
-            # the node may be an oscillator
-            # in that case, mean amplitude may be low
-            oscillators.append(index)
-            oscillators_series.append(seq)
+    # the diagonal contains the self-loop time series of each node
+    diag = np.diagonal(difmats, axis1=1, axis2=2)
+    # node amplitude is NOT correlated to position in network
+    # if the amplitude is large, the node may be an oscillator
+    # in that case, mean amplitude may be low
+    oscillators = np.nonzero(np.ptp(diag, axis=0) > 0.5)[0]
+    oscillators_series = diag[:, oscillators].T
     if len(oscillators) == 0:
         logger.warning("No oscillating nodes found.\n"
                        "No weak and strong clustering assignments can be made.\n"
@@ -416,47 +518,34 @@ def _core_oscillators(difmats, assignment, adj_index, rev_index, verbose):
     oscillators = [rev_index[x] for x in oscillators]
     if verbose:
         logger.info('Found the following strong oscillators: ' + str(oscillators))
-    amplis = dict()
-    clusdict = dict.fromkeys(oscillators)
-    for x in clusdict:
-        clusdict[x] = assignment[adj_index[x]]
+    clusdict = {x: assignment[adj_index[x]] for x in oscillators}
     # we find anti-correlated oscillator nodes
     # there should be at least one node represented for each cluster
-    for pair in combinations(range(len(oscillators)), 2):
-        total = oscillators_series[pair[0]] - oscillators_series[pair[1]]
-        # need to be careful with this number,
-        # the core oscillators should converge to 1 and -1
-        # but may stick a little below that value
-        amplis[(oscillators[pair[0]], oscillators[pair[1]])] = (np.max(total) - np.min(total))
+    # need to be careful with this number,
+    # the core oscillators should converge to 1 and -1
+    # but may stick a little below that value
+    pair_amplis = np.ptp(oscillators_series[:, None, :] - oscillators_series[None, :, :], axis=2)
     # need to find the largest anti-correlation per cluster
-    clus_corrs = dict.fromkeys(set(assignment), 0)
-    clus_nodes = dict.fromkeys(set(assignment))
-    for corr in amplis:
-        cluster1 = clusdict[corr[0]]
-        cluster2 = clusdict[corr[1]]
-        if amplis[corr] > clus_corrs[cluster1]:
-            clus_nodes[cluster1] = corr
-            clus_corrs[cluster1] = amplis[corr]
-        if amplis[corr] > clus_corrs[cluster2]:
-            clus_nodes[cluster2] = corr
-            clus_corrs[cluster2] = amplis[corr]
-    clus_nodes = {k: v for k, v in clus_nodes.items() if v is not None}
-    # it is possible for clusters to not have a strong oscillator
+    # pairs are ranked in the upper triangle, so ties go to the first pair
+    osc_clusters = np.array([clusdict[x] for x in oscillators])
+    upper_amplis = np.triu(pair_amplis, k=1)
+    clus_nodes = dict()
+    for cluster in set(assignment):
+        members = osc_clusters == cluster
+        # it is possible for clusters to not have a strong oscillator
+        if not members.any():
+            continue
+        cluster_amplis = np.where(members[:, None] | members[None, :], upper_amplis, 0)
+        i, j = np.unravel_index(np.argmax(cluster_amplis), cluster_amplis.shape)
+        if cluster_amplis[i, j] > 0:
+            clus_nodes[cluster] = (oscillators[i], oscillators[j])
     core_oscillators = set(list(chain.from_iterable(list(clus_nodes.values()))))
-    id_corrs = dict.fromkeys(core_oscillators, 0)
-    anti_sizes = dict.fromkeys(core_oscillators, 0)
-    for nodes in combinations(core_oscillators, 2):
-        try:
-            size = amplis[nodes]
-        except KeyError:
-            size = amplis[(nodes[1], nodes[0])]
-        if size > anti_sizes[nodes[0]]:
-            id_corrs[nodes[0]] = nodes[1]
-            anti_sizes[nodes[0]] = size
-        if size > anti_sizes[nodes[1]]:
-            id_corrs[nodes[1]] = nodes[0]
-            anti_sizes[nodes[1]] = size
-    [clusdict.pop(x) for x in list(clusdict.keys()) if x not in core_oscillators]
+    # each core oscillator is matched to the core oscillator it is most anti-correlated with
+    osc_index = {x: i for i, x in enumerate(oscillators)}
+    core_list = list(core_oscillators)
+    core_locs = np.array([osc_index[x] for x in core_list], dtype=int)
+    core_amplis = pair_amplis[np.ix_(core_locs, core_locs)]
+    id_corrs = {x: core_list[np.argmax(core_amplis[i])] for i, x in enumerate(core_list)}
     anti_corrs = dict()
     for core in core_oscillators:
         anti_corrs[clusdict[core]] = clusdict[id_corrs[core]]
@@ -464,7 +553,7 @@ def _core_oscillators(difmats, assignment, adj_index, rev_index, verbose):
     return core_oscillators, anti_corrs
 
 
-def _oscillator_paths(graph, core_oscillators,
+def _oscillator_paths(graph, edge_arrays, core_oscillators,
                       assignment, adj_index, edgescale, verbose):
     """
     Given optimal cluster assignments and a set of core oscillators,
@@ -475,6 +564,7 @@ def _oscillator_paths(graph, core_oscillators,
     Parameters
     ----------
     :param graph: NetworkX weighted, undirected graph
+    :param edge_arrays: Tuple of edge arrays generated by _edge_arrays
     :param core_oscillators: List of core oscillators
     :param anti_corrs: Dictionary  of anti-correlated oscillators
     :param assignment: Cluster assignment
@@ -484,15 +574,12 @@ def _oscillator_paths(graph, core_oscillators,
     :return: List of node indices that are in conflict with oscillators
     """
     # get all shortest paths to/from oscillators
-    corrdict = _path_weights(core_oscillators, graph, verbose)
+    corrdict = _path_weights(core_oscillators, graph, edge_arrays, adj_index, verbose)
     varweights = list()  # stores nodes that have low weights of mean shortest paths
     clus_matches = list()  # stores nodes that have matching signs for oscillators
     clus_assign = list()  # stores nodes that have negative shortest paths to cluster oscillator
     # first need to scale weight variables for this
-    clusdict = dict.fromkeys(core_oscillators)
-    for x in clusdict:
-        clusdict[x] = assignment[adj_index[x]]
-    clusdict = {v: k for k, v in clusdict.items()}
+    clusdict = {assignment[adj_index[x]]: x for x in core_oscillators}
     for target in graph.nodes:
         clus_id = assignment[adj_index[target]]
         try:
@@ -515,64 +602,117 @@ def _oscillator_paths(graph, core_oscillators,
     return list(remove_cluster)
 
 
-def _node_sparsity(graph, removals, assignment, rev_index):
-    default_sparsity = sparsity_score(graph, assignment, rev_index)
+def _node_sparsity(edge_arrays, removals, assignment):
+    """
+    Given a list of nodes that are candidates for removal,
+    this function checks whether assigning these nodes to another cluster
+    has a large impact on the sparsity score.
+    Nodes for which all other assignments strongly decrease the sparsity score
+    are not removed.
+    Trial assignments are made in the assignment vector itself;
+    the original cluster ID is restored before the function returns.
+
+    Parameters
+    ----------
+    :param edge_arrays: Tuple of edge arrays generated by _edge_arrays
+    :param removals: List of node indices that are candidates for removal
+    :param assignment: Vector of cluster identities, in matrix index order
+    :return: Updated list of node indices
+    """
+    default_sparsity = sparsity_score(assignment, *edge_arrays)
     clusters = set(assignment)
-    updated_removals = deepcopy(removals)
+    updated_removals = list(removals)
     for node in removals:
         clus_id = list()
         clus_id.append(assignment[node])
         other_ids = list(clusters.difference(clus_id))
-        other_sparsities = list()
-        for id in other_ids:
-            updated_assignment = deepcopy(assignment)
-            updated_assignment[node] = id
-            other_sparsities.append(sparsity_score(graph, updated_assignment, rev_index))
-        if np.max(other_sparsities) < (default_sparsity - 0.3):
+        old_id = assignment[node]
+        # a single alternative assignment with a similar sparsity score is enough to remove the node
+        removable = False
+        try:
+            for id in other_ids:
+                assignment[node] = id
+                if sparsity_score(assignment, *edge_arrays) >= (default_sparsity - 0.3):
+                    removable = True
+                    break
+        finally:
+            assignment[node] = old_id
+        if not removable:
             updated_removals.remove(node)
     return updated_removals
 
 
-def _path_weights(source, graph, verbose):
+def _path_weights(source, graph, edge_arrays, adj_index, verbose):
     """
-    Given a list of nodes, this function returns a dictionary of all shortest path weights
+    Given a list of nodes, this function returns a dictionary of shortest path weights
     from the sources to all other nodes in the network.
+    The shortest path is the path with the largest absolute product of scaled edge weights,
+    found with Dijkstra's algorithm on the negative logarithm of the edge weights.
 
     Parameters
     ----------
     :param source: List of source nodes
     :param graph: NetworkX graph object
+    :param edge_arrays: Tuple of edge arrays generated by _edge_arrays
+    :param adj_index: Index matching node ID to matrix index
     :param verbose: Verbosity level of function
     :return: Dictionary of shortest path weights
     """
-    corrdict = dict.fromkeys(source)
-    weights = nx.get_edge_attributes(graph, 'weight')
-    max_weight = max(weights.values())
-    weights = {k: v / max_weight for k, v in weights.items()}
-    rev_weights = dict()
-    for key in weights:
-        newkey = (key[1], key[0])
-        rev_weights[newkey] = weights[key]
-    weights = {**weights, **rev_weights}
+    source = list(source)
+    if len(source) == 0:
+        return dict()
+    edge_u, edge_v, edge_w = edge_arrays
+    size = len(adj_index)
     # first scale edge weights
-    for node in source:
-        targets = list(graph.nodes)
-        corrdict[node] = dict()
-        for target in targets:
-            try:
-                shortest_paths = list(nx.all_shortest_paths(graph, source=node, target=target))
-                total_weight = 0
-                for path in shortest_paths:
-                    edge_weight = 1
-                    for i in range(len(path) - 1):
-                        edge_weight *= weights[(path[i], path[i + 1])]
-                    total_weight += edge_weight
-                total_weight = total_weight / len(shortest_paths)
-            except nx.exception.NetworkXNoPath:
-                if verbose:
-                    logger.warning("Could not find shortest path for: " + target)
-                total_weight = -1
-            corrdict[node][target] = total_weight
+    # scaling by the largest absolute weight keeps all logarithms non-negative
+    abs_w = np.abs(edge_w)
+    # graphs without weighted edges have no paths to scale
+    max_weight = np.max(abs_w) if abs_w.any() else 1
+    # edge products along a path are computed as a sum of logarithms and a product of signs
+    log_abs_w = np.log(np.maximum(abs_w / max_weight, 1e-12))
+    sign_w = np.sign(edge_w)
+    # the small cost per edge makes ties between equal-weight paths go to the path with the fewest edges
+    lengths = csr_matrix((1e-6 - log_abs_w, (edge_u, edge_v)), shape=(size, size))
+    dists, parents = dijkstra(lengths, directed=nx.is_directed(graph),
+                              indices=[adj_index[x] for x in source], return_predecessors=True)
+    # parent edges are looked up as edge positions, starting at 1
+    # position 0 is used for nodes without a parent and adds nothing to the edge product
+    edge_pos = np.arange(1, len(edge_w) + 1)
+    if not nx.is_directed(graph):
+        # undirected edges can be walked in both directions, self-loops only once
+        mirror = edge_u != edge_v
+        edge_u, edge_v = np.concatenate((edge_u, edge_v[mirror])), np.concatenate((edge_v, edge_u[mirror]))
+        edge_pos = np.concatenate((edge_pos, edge_pos[mirror]))
+    edge_lookup = csr_matrix((edge_pos, (edge_u, edge_v)), shape=(size, size))
+    log_abs_w = np.concatenate(([0], log_abs_w))
+    sign_w = np.concatenate(([1], sign_w))
+    # the shortest path trees are walked by pointer jumping,
+    # so each node accumulates the edge product of its path to the source
+    rows = np.arange(len(source))[:, None]
+    targets = np.broadcast_to(np.arange(size), parents.shape)
+    # sources and unreachable nodes have no parent, so they are their own root
+    roots = parents < 0
+    parents = np.where(roots, targets, parents)
+    parent_edges = np.asarray(edge_lookup[parents.ravel(), targets.ravel()]).reshape(parents.shape)
+    # a self-loop on a root is not part of any path
+    parent_edges[roots] = 0
+    log_products = log_abs_w[parent_edges]
+    sign_products = sign_w[parent_edges]
+    while True:
+        ancestors = parents[rows, parents]
+        if np.array_equal(ancestors, parents):
+            break
+        log_products = log_products + log_products[rows, parents]
+        sign_products = sign_products * sign_products[rows, parents]
+        parents = ancestors
+    path_weights = np.where(np.isinf(dists), -1, sign_products * np.exp(log_products))
+    nodes = sorted(adj_index, key=adj_index.get)
+    corrdict = dict()
+    for i in range(len(source)):
+        if verbose:
+            for loc in np.flatnonzero(np.isinf(dists[i])):
+                logger.warning("Could not find shortest path for: " + nodes[loc])
+        corrdict[source[i]] = dict(zip(nodes, path_weights[i]))
     return corrdict
 
 
@@ -588,8 +728,10 @@ def _remove_node(loc, mat, mat_index):
     :param mat_index: Matrix index
     :return: Tuple of  matrix and matrix_index
     """
-    mat = np.delete(mat, loc, axis=0)
-    mat = np.delete(mat, loc, axis=1)
+    # rows and columns are removed in a single copy of the matrix
+    keep = np.ones(mat.shape[0], dtype=bool)
+    keep[loc] = False
+    mat = mat[np.ix_(keep, keep)]
     if type(loc) == list:
         loc.sort()
     else:
@@ -218,7 +218,7 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
 
     # scoremat indices are ordered by graph.nodes()
     scoremat = nx.to_numpy_array(graph)
-    mat_index = {list(graph.nodes)[i]: i for i in range(len(graph.nodes))}
+    mat_index = {node: i for i, node in enumerate(graph.nodes)}
     nums = int(len(graph)*subset)  # fraction of edges in subnetwork set to 0
     # this fraction can be set to 0.8 or higher, gives good results
     # results in file manta_ratio_perm.csv
@@ -247,12 +247,8 @@ def partial_diffusion(graph, iterations, limit, subset, ratio, permutations, ver
                     partial_score = diffusion(graph=component, limit=limit,
                                               iterations=iterations, verbose=False)[0]
                     # map score matrix to balanced_matrix
-                    for i in range(partial_score.shape[0]):
-                        for j in range(partial_score.shape[0]):
-                            node_ids = [list(component.nodes)[i],
-                                        list(component.nodes)[j]]
-                            mat_ids = [mat_index[node] for node in node_ids]
-                            balanced_matrix[mat_ids[0], mat_ids[1]] = partial_score[i,j]
+                    mat_ids = [mat_index[node] for node in component.nodes]
+                    balanced_matrix[np.ix_(mat_ids, mat_ids)] = partial_score
             # carry out 1 step propagation on entire matrix
         submat = np.copy(scoremat)
         submat[num_indices, :] = 0
@@ -85,9 +85,8 @@ def central_edge(graph, percentile, permutations, error, verbose):
     posthresh = np.percentile(scoremat, 100-percentile)
     neghubs = list(map(tuple, np.argwhere(scoremat <= negthresh)))
     poshubs = list(map(tuple, np.argwhere(scoremat >= posthresh)))
-    adj_index = dict()
-    for i in range(len(graph.nodes)):
-        adj_index[list(graph.nodes)[i]] = i
+    nodes = list(graph.nodes)
+    adj_index = {node: i for i, node in enumerate(nodes)}
     if permutations > 0:
         score = perm_edges(graph, percentile=percentile, permutations=permutations,
                            pos=poshubs, neg=neghubs, error=error)
@@ -98,14 +97,14 @@ def central_edge(graph, percentile, permutations, error, verbose):
     edge_scores = dict()
     # need to convert matrix index to node ID
     for edge in neghubs:
-        node1 = list(graph.nodes)[edge[0]]
-        node2 = list(graph.nodes)[edge[1]]
+        node1 = nodes[edge[0]]
+        node2 = nodes[edge[1]]
         edge_vals[(node1, node2)] = 'negative hub'
         if permutations > 0 and score is not None:
             edge_scores[(node1, node2)] = score[(adj_index[node1], adj_index[node2])]
     for edge in poshubs:
-        node1 = list(graph.nodes)[edge[0]]
-        node2 = list(graph.nodes)[edge[1]]
+        node1 = nodes[edge[0]]
+        node2 = nodes[edge[1]]
         edge_vals[(node1, node2)] = 'positive hub'
         if permutations > 0 and score is not None:
             edge_scores[(node1, node2)] = score[(adj_index[node1], adj_index[node2])]
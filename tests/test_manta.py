@@ -10,13 +10,15 @@ __license__ = 'Apache 2.0'
 
 import unittest
 import networkx as nx
-from manta.cluster import cluster_graph, sparsity_score, cluster_weak, cluster_hard, _cluster_vector
+from manta.cluster import cluster_graph, sparsity_score, cluster_weak, cluster_hard, _cluster_vector, _edge_arrays, \
+    _path_weights, _sparsity_kernel
 from manta.flow import diffusion, harary_balance, harary_components
 from manta.reliability import central_edge, central_node, rewire_graph, perm_edges
 from manta.layout import generate_layout, generate_tax_weights
 from copy import deepcopy
 import numpy as np
 from io import StringIO
+from unittest import mock
 from sklearn.cluster import KMeans
 
 g = nx.Graph()
@@ -193,6 +195,19 @@ class TestMain(unittest.TestCase):
         # those are too harsh and were therefore removed.
         self.assertEqual(len(bestcluster), 0)
 
+    def test_cluster_weak_no_oscillators(self):
+        """
+        Checks whether cluster_weak returns no weak nodes
+        if the diffusion matrices do not contain oscillators.
+        """
+        adj_index = {node: i for i, node in enumerate(g.nodes)}
+        rev_index = {i: node for i, node in enumerate(g.nodes)}
+        diffs = [np.zeros((len(g), len(g)))] * 5
+        cluster = np.array([0, 0, 0, 0, 0, 1, 1, 1, 1, 1])
+        weak_nodes = cluster_weak(graph=g, diffs=diffs, cluster=cluster, edgescale=0.5, adj_index=adj_index,
+                                  rev_index=rev_index, verbose=verbose)
+        self.assertEqual(len(weak_nodes), 0)
+
     def test_cluster_manta(self):
         """
         Checks whether the correct cluster IDs are assigned.
@@ -267,10 +282,43 @@ class TestMain(unittest.TestCase):
         adj_index = dict()
         for i in range(len(g.nodes)):
             adj_index[list(g.nodes)[i]] = i
-        rev_index = {v: k for k, v in adj_index.items()}
-        sparsity = sparsity_score(g, clusters, rev_index)
+        sparsity = sparsity_score(clusters, *_edge_arrays(g, adj_index))
         self.assertEqual(int(sparsity), 1)
 
+    def test_sparsity_kernel(self):
+        """
+        Checks whether the numpy sparsity score, the loop kernel
+        and the numba-compiled kernel give the same exact score.
+        With this assignment, 8 edges are rewarded and 3 edges are penalized,
+        so the score should be 5 / 11.
+        """
+        adj_index = {node: i for i, node in enumerate(g.nodes)}
+        edge_arrays = _edge_arrays(g, adj_index)
+        clusters = np.array([0, 0, 0, 1, 0, 1, 0, 1, 1, 1])
+        with mock.patch('manta.cluster.njit', None):
+            self.assertEqual(sparsity_score(clusters, *edge_arrays), 5 / 11)
+        # without numba, the kernel is not compiled and has no py_func
+        kernel = getattr(_sparsity_kernel, 'py_func', _sparsity_kernel)
+        self.assertEqual(kernel(clusters, *edge_arrays), 5 / 11)
+        self.assertEqual(_sparsity_kernel(clusters, *edge_arrays), 5 / 11)
+
+    def test_path_weights(self):
+        """
+        Checks whether the shortest path weights carry the sign of the edge product.
+        The path from OTU_1 to OTU_4 crosses a single negative edge.
+        A self-loop on the source should not be included in any path.
+        """
+        adj_index = {node: i for i, node in enumerate(g.nodes)}
+        corrdict = _path_weights(["OTU_1"], g, _edge_arrays(g, adj_index), adj_index, verbose)
+        self.assertAlmostEqual(corrdict["OTU_1"]["OTU_4"], -1, places=3)
+        self.assertAlmostEqual(corrdict["OTU_1"]["OTU_1"], 1)
+        loopg = nx.Graph()
+        loopg.add_weighted_edges_from([("OTU_1", "OTU_1", 0.2), ("OTU_1", "OTU_2", -0.5), ("OTU_2", "OTU_3", 1)])
+        adj_index = {node: i for i, node in enumerate(loopg.nodes)}
+        corrdict = _path_weights(["OTU_1"], loopg, _edge_arrays(loopg, adj_index), adj_index, verbose)
+        self.assertEqual(corrdict["OTU_1"]["OTU_1"], 1)
+        self.assertAlmostEqual(corrdict["OTU_1"]["OTU_3"], -0.5)
+
     def test_tax_weights(self):
         """
         Checks whether the tax weights for the edges are correctly calculated.